@@ -1,47 +1,59 @@
-import yaml, polars as pl, requests, click
+import yaml, polars as pl, requests, click, threading
 from datetime import datetime
-from utils.parse_address import find_address_fields, parse_address
-from utils.ais_lookup import throttle_ais_lookup
+from utils.parse_address import (
+    ParseCache,
+    find_address_fields,
+    join_address_fields,
+    parse_distinct_addresses,
+)
+from utils.ais_lookup import (
+    AIS_RATE_LIMIT,
+    CircuitBreaker,
+    SharedRateLimiter,
+    retry_with_backoff,
+    throttle_ais_lookup,
+)
+from utils.boundaries import assign_boundary_fields, load_boundary_files
+from utils.pipeline import StagedPipeline
+from utils.plan import build_plan, format_plan
 from mapping.ais_properties_fields import fields
 from passyunk.parser import PassyunkParser
 from pathlib import PurePath
 
+# Defaults for the optional performance settings in the config file
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_AIS_WORKERS = 4
+
 
 def get_current_time():
     current_datetime = datetime.now()
     return current_datetime.strftime("%H:%M:%S")
 
 
-def parse_with_passyunk_parser(lf: pl.LazyFrame) -> pl.LazyFrame:
+def parse_with_passyunk_parser(
+    df: pl.DataFrame, parser=None, cache: ParseCache = None
+) -> pl.DataFrame:
     """
-    Given a polars LazyFrame, parses addresses in that LazyFrame
-    using passyunk parser, and adds output address.
+    Given a polars DataFrame, parses addresses in that DataFrame
+    using passyunk parser, and adds output address. Each distinct
+    address is only parsed once.
 
     Args:
-        lf: The polars lazyframe with an address field to parse
+        df: The polars dataframe with an address field to parse
+        parser: An optional PassyunkParser object to reuse between calls
+        cache: An optional ParseCache of parsed addresses to reuse between calls
 
     Returns:
-        A polars lazyframe with output address, and address validity booleans
+        A polars dataframe with output address, and address validity booleans
         added.
     """
-    p = PassyunkParser()
-
-    # Create struct of columns to be filled by parse address function
-    new_cols = pl.Struct(
-        [
-            pl.Field("output_address", pl.String),
-            pl.Field("is_addr", pl.Boolean),
-            pl.Field("is_philly_addr", pl.Boolean),
-        ]
-    )
+    p = parser or PassyunkParser()
 
-    lf = lf.with_columns(
-        pl.col("joined_address")
-        .map_elements(lambda s: parse_address(p, s), return_dtype=new_cols)
-        .alias("temp_struct")
-    ).unnest("temp_struct")
+    parsed = parse_distinct_addresses(
+        p, df["joined_address"], cache if cache is not None else ParseCache()
+    )
 
-    return lf
+    return df.join(parsed, how="left", on="joined_address", maintain_order="left")
 
 
 def build_enrichment_fields(config: dict) -> tuple[list, list]:
@@ -76,31 +88,94 @@ def build_enrichment_fields(config: dict) -> tuple[list, list]:
     return (ais_enrichment_fields, address_file_fields)
 
 
+def load_address_file(geo_filepath: str, address_fields: list) -> pl.DataFrame:
+    """
+    Reads the given fields from the address file into memory, so that
+    they can be joined to each batch of input data without re-reading
+    the file.
+    """
+    return pl.read_parquet(geo_filepath, columns=address_fields)
+
+
 def add_address_file_fields(
-    geo_filepath: str, input_data: pl.LazyFrame, address_fields: list
-) -> pl.LazyFrame:
+    addresses: pl.DataFrame, input_data: pl.DataFrame, address_fields: list
+) -> pl.DataFrame:
     """
     Given a list of address fields to add, adds those fields from
     the address file to each record in the input data. Does so via a
-    left join on the full address.
+    left join on the full address, keeping the order of the input data.
     """
-    addresses = pl.scan_parquet(geo_filepath)
-    addresses = addresses.select(address_fields)
-
     rename_mapping = {
         value: key for key, value in fields.items() if value in address_fields
     }
 
-    joined_lf = input_data.join(
-        addresses, how="left", left_on="output_address", right_on="street_address"
+    joined = input_data.join(
+        addresses,
+        how="left",
+        left_on="output_address",
+        right_on="street_address",
+        maintain_order="left",
     ).rename(rename_mapping)
 
-    return joined_lf
+    return joined
+
+
+def add_input_coordinates(data: pl.DataFrame, coordinate_fields: dict) -> pl.DataFrame:
+    """
+    Fills missing latitude and longitude from coordinate columns already
+    in the input file.
+
+    Args:
+        data: A polars dataframe joined to the address file
+        coordinate_fields: A dict with the names of the input latitude
+            and longitude columns
+
+    Returns:
+        The dataframe with input coordinates added where missing.
+    """
+    lat_field = coordinate_fields.get("latitude")
+    lon_field = coordinate_fields.get("longitude")
+
+    if not lat_field or not lon_field:
+        raise ValueError("coordinate_fields must include both latitude and longitude.")
+
+    use_input = (
+        pl.col(lat_field).is_not_null()
+        & pl.col(lon_field).is_not_null()
+        & (pl.col("geocode_lat").is_null() | pl.col("geocode_lon").is_null())
+    )
+
+    return data.with_columns(
+        *[
+            pl.when(use_input)
+            .then(pl.col(field).cast(data.schema[geo_field], strict=False))
+            .otherwise(pl.col(geo_field))
+            .alias(geo_field)
+            for field, geo_field in [
+                (lat_field, "geocode_lat"),
+                (lon_field, "geocode_lon"),
+            ]
+        ]
+    )
 
 
-def split_geos(data: pl.LazyFrame):
+def find_ais_lookup_fields(config: dict, ais_enrichment_fields: list) -> list:
     """
-    Splits a lazyframe into two lazy frames: one for records with latitude
+    Returns the enrichment fields that still need to come from AIS, which
+    are those not filled from a boundary file listed in the config.
+    """
+    boundary_fields = {
+        field
+        for boundary_file in config.get("boundary_files") or []
+        for field in boundary_file.get("fields") or {}
+    }
+
+    return [f for f in ais_enrichment_fields if f not in boundary_fields]
+
+
+def split_geos(data: pl.DataFrame):
+    """
+    Splits a dataframe into two dataframes: one for records with latitude
     and longitude, and another for records without latitude and longitude.
     Used to determine which records need to be added using AIS.
     """
@@ -114,51 +189,124 @@ def split_geos(data: pl.LazyFrame):
     return (has_geo, needs_geo)
 
 
-def enrich_with_ais(
-    config: dict, to_add: pl.LazyFrame, enrichment_fields: list
-) -> pl.LazyFrame:
+def build_ais_schema(enrichment_fields: list) -> dict:
+    """
+    Returns the polars schema of the fields returned by an AIS lookup.
+    """
+    return {
+        "output_address": pl.String,
+        "is_addr": pl.Boolean,
+        "is_philly_addr": pl.Boolean,
+        "geocode_lat": pl.String,
+        "geocode_lon": pl.String,
+        **{field: pl.String for field in enrichment_fields},
+        "ais_status": pl.String,
+    }
+
+
+def build_ais_failure() -> dict:
     """
-    Adds user-specified fields to a polars lazyframe from AIS.
+    Returns the AIS result for an address that could not be looked up.
+    Only ais_status is set, so the record keeps its parsed values.
+    """
+    return {"ais_status": "failed"}
+
+
+def make_ais_lookup(config: dict, enrichment_fields: list) -> tuple:
+    """
+    Builds functions that look up one address in AIS. Each thread that
+    calls them gets its own requests session. Requests are rate limited
+    together with every other geocoder job using the same API key, and
+    stopped by a circuit breaker while AIS is failing.
 
     Args:
         config: A user config dict
-        to_add: A polars lazyframe to be enriched
         enrichment_fields: A list of enrichment fields specified by the user
 
     Returns:
-        An enriched polars lazyframe
+        A tuple of two functions that take an address and return a dict of
+        AIS fields, with ais_status set to found or not_found. The first
+        raises CircuitOpenError while the circuit breaker is open. The
+        second, for retrying failed lookups, retries with backoff and waits
+        out one cooldown of the circuit breaker before failing.
     """
+    API_KEY = config.get("AIS_API_KEY")
+    local = threading.local()
 
-    new_cols = pl.Struct(
-        [
-            pl.Field("output_address", pl.String),
-            pl.Field("is_addr", pl.Boolean),
-            pl.Field("is_philly_addr", pl.Boolean),
-            pl.Field("geocode_lat", pl.String),
-            pl.Field("geocode_lon", pl.String),
-            *[pl.Field(field, pl.String) for field in enrichment_fields],
-        ]
+    rate_limiter = SharedRateLimiter(
+        API_KEY,
+        config.get("ais_rate_limit") or AIS_RATE_LIMIT,
+        config.get("rate_limit_file"),
     )
+    circuit_breaker = CircuitBreaker()
+
+    def lookup(address: str, block: bool = False) -> dict:
+        if not hasattr(local, "sess"):
+            local.sess = requests.Session()
+
+        result = throttle_ais_lookup(
+            local.sess,
+            API_KEY,
+            address,
+            enrichment_fields,
+            rate_limiter,
+            circuit_breaker,
+            block,
+        )
+        result["ais_status"] = "found" if result["is_addr"] else "not_found"
 
-    API_KEY = config.get("AIS_API_KEY")
+        return result
 
-    field_names = [f.name for f in new_cols.fields]
-
-    with requests.Session() as sess:
-        added = (
-            to_add.with_columns(
-                pl.col("output_address")
-                .map_elements(
-                    lambda a: throttle_ais_lookup(sess, API_KEY, a, enrichment_fields),
-                    return_dtype=new_cols,
-                )
-                .alias("temp_struct")
-            )
-            .with_columns(
-                *[pl.col("temp_struct").struct.field(n).alias(n) for n in field_names]
-            )
-            .drop("temp_struct")
+    @retry_with_backoff
+    def retry_lookup(address: str) -> dict:
+        return lookup(address, block=True)
+
+    return (lookup, retry_lookup)
+
+
+def enrich_with_ais(
+    to_add: pl.DataFrame, results: dict, enrichment_fields: list
+) -> pl.DataFrame:
+    """
+    Adds user-specified fields from AIS lookup results to a polars dataframe.
+
+    Args:
+        to_add: A polars dataframe to be enriched
+        results: A dict of AIS lookup results, keyed by output address
+        enrichment_fields: A list of enrichment fields specified by the user
+
+    Returns:
+        An enriched polars dataframe
+    """
+    schema = build_ais_schema(enrichment_fields)
+
+    ais = pl.DataFrame(
+        [{"__ais_address__": address, **result} for address, result in results.items()],
+        schema={"__ais_address__": pl.String, **schema},
+    )
+
+    added = (
+        to_add.join(
+            ais,
+            how="left",
+            left_on="output_address",
+            right_on="__ais_address__",
+            suffix="__ais",
         )
+        .with_columns(
+            # Records whose lookup failed keep the values they already had
+            *[
+                pl.when(pl.col("ais_status__ais") == "failed")
+                .then(pl.col(n))
+                .otherwise(pl.col(f"{n}__ais"))
+                .alias(n)
+                for n in schema
+                if n != "ais_status"
+            ],
+            pl.col("ais_status__ais").alias("ais_status"),
+        )
+        .drop([f"{n}__ais" for n in schema])
+    )
 
     return added
 
@@ -171,14 +319,27 @@ def enrich_with_ais(
     show_default="./config.yml",
     help="The path to the config file.",
 )
-def process_csv(config_path) -> pl.LazyFrame:
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Estimate AIS load and runtime without geocoding the file.",
+)
+@click.option(
+    "--sample_size",
+    default=5000,
+    show_default=True,
+    help="The number of distinct addresses to parse when planning.",
+)
+def process_csv(config_path, plan, sample_size) -> pl.LazyFrame:
     """
     Given a config file with the csv filepath, normalizes records
     in that file using Passyunk.
 
     Args:
         config_path (str): The path to the config file
-        chunksize (int): Batch size for file reading
+        plan (bool): Only report estimated AIS load and runtime
+        sample_size (int): Distinct addresses to parse when planning
 
     Returns: A polars lazy dataframe
     """
@@ -195,49 +356,87 @@ def process_csv(config_path) -> pl.LazyFrame:
         raise ValueError(
             "A filepath for the geography file must be" "specified in the config."
         )
-    # ---------------- Join Addresses to Address File -------------------#
-
-    current_time = get_current_time()
-    print(f"Joining addresses to address file at {current_time}.")
 
     # Determine which fields in the file are the address fields
     address_fields = find_address_fields(config_path)
 
-    lf = pl.scan_csv(filepath, row_index_name="__geocode_idx__")
-
-    # Concatenate address fields, strip extra spaces
-    lf = lf.with_columns(
-        pl.concat_str(
-            [pl.col(field).fill_null("") for field in address_fields], separator=" "
-        )
-        .str.replace_all(r"\s+", " ")
-        .alias("joined_address")
-    )
-
-    lf = parse_with_passyunk_parser(lf)
+    ais_workers = config.get("ais_workers") or DEFAULT_AIS_WORKERS
 
     # Generate the names of columns to add for both the AIS API
     # and the address file
     ais_enrichment_fields, address_file_enrichment_fields = build_enrichment_fields(config)
 
-    joined_lf = add_address_file_fields(geo_filepath, lf, address_file_enrichment_fields)
+    # Polygon-based fields with a boundary file are filled locally from
+    # coordinates, so they do not need to come from AIS
+    ais_lookup_fields = find_ais_lookup_fields(config, ais_enrichment_fields)
+
+    if plan:
+        current_time = get_current_time()
+        print(f"Planning geocoder run at {current_time}.")
+
+        plan_stats = build_plan(
+            PassyunkParser(),
+            filepath,
+            geo_filepath,
+            address_fields,
+            sample_size,
+            rate=config.get("ais_rate_limit") or AIS_RATE_LIMIT,
+            concurrency=ais_workers,
+            coordinate_fields=config.get("coordinate_fields"),
+            ais_lookup_fields=ais_lookup_fields,
+        )
+        print(format_plan(plan_stats))
+        return
 
-    # Split out fields that did not match the address file
-    # and attempt to match them with the AIS API
+    # ------------------ Add Fields from Address File and AIS ---------------- #
 
-    # -------------------------- Add Fields from AIS ------------------ #
     current_time = get_current_time()
-    print(f"Adding fields from AIS at {get_current_time()}")
+    print(f"Adding fields from address file and AIS at {current_time}.")
 
-    has_geo, needs_geo = split_geos(joined_lf)
+    boundary_layers = load_boundary_files(config)
 
-    ais_enriched = enrich_with_ais(config, needs_geo, ais_enrichment_fields)
+    coordinate_fields = config.get("coordinate_fields") or {}
+    has_coordinate_fields = any(coordinate_fields.values())
 
-    rejoined = (
-        pl.concat([has_geo, ais_enriched])
-        .sort("__geocode_idx__")
-        .drop(["__geocode_idx__", "joined_address"])
-    )
+    # Records with input coordinates only skip AIS when boundary files
+    # cover every AIS field. Otherwise they are still looked up, and their
+    # coordinates are used if AIS cannot find the address.
+    coordinates_skip_ais = has_coordinate_fields and not ais_lookup_fields
+
+    parser = PassyunkParser()
+    parse_cache = ParseCache()
+
+    addresses = load_address_file(geo_filepath, address_file_enrichment_fields)
+
+    def prepare(batch: pl.DataFrame) -> tuple:
+        # Concatenate address fields, strip extra spaces
+        df = batch.with_columns(join_address_fields(address_fields))
+
+        df = parse_with_passyunk_parser(df, parser, parse_cache)
+
+        joined = add_address_file_fields(addresses, df, address_file_enrichment_fields)
+
+        if coordinates_skip_ais:
+            joined = add_input_coordinates(joined, coordinate_fields)
+
+        joined = assign_boundary_fields(joined, boundary_layers)
+
+        # Filled in for records sent to AIS
+        joined = joined.with_columns(pl.lit(None, dtype=pl.String).alias("ais_status"))
+
+        # Split out fields that did not match the address file
+        # so they can be matched with the AIS API
+        _, needs_geo = split_geos(joined)
+
+        return (joined, needs_geo)
+
+    def finish(needs_geo: pl.DataFrame, results: dict) -> pl.DataFrame:
+        enriched = enrich_with_ais(needs_geo, results, ais_lookup_fields)
+
+        if has_coordinate_fields:
+            enriched = add_input_coordinates(enriched, coordinate_fields)
+
+        return assign_boundary_fields(enriched, boundary_layers)
 
     in_path = PurePath(filepath)
 
@@ -248,7 +447,41 @@ def process_csv(config_path) -> pl.LazyFrame:
 
     out_path = str(in_path.parent / out_path)
 
-    rejoined.sink_csv(out_path)
+    batches = pl.scan_csv(filepath, row_index_name="__geocode_idx__").collect_batches(
+        chunk_size=config.get("batch_size") or DEFAULT_BATCH_SIZE
+    )
+
+    # Parsing and joining run on this thread while AIS lookups for earlier
+    # batches run on worker threads
+    with open(out_path, "wb") as out_file:
+
+        def write(batch: pl.DataFrame):
+            batch.drop(["__geocode_idx__", "joined_address"]).write_csv(
+                out_file, include_header=out_file.tell() == 0
+            )
+
+        lookup, retry_lookup = make_ais_lookup(config, ais_lookup_fields)
+
+        # Failed lookups, including those stopped by the circuit breaker, are
+        # retried after the main pass, and records that still fail are
+        # written with an ais_status of failed
+        pipeline = StagedPipeline(
+            prepare,
+            lookup,
+            finish,
+            write,
+            workers=ais_workers,
+            retry_lookup=retry_lookup,
+            on_failure=lambda address, error: build_ais_failure(),
+        )
+
+        pipeline.run(batches)
+
+    if pipeline.failed:
+        print(
+            f"{len(pipeline.failed):,} addresses could not be looked up in AIS. "
+            "These records have an ais_status of failed."
+        )
 
     current_time = get_current_time()
     print(f"Enrichment complete at {current_time}.")
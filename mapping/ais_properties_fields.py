@@ -82,3 +82,59 @@ fields = {
     "engine_local": "engine_local",
     "ladder_local": "ladder_local",
 }
+
+# Fields that AIS assigns by finding which polygon an address falls in.
+# These can be filled locally from boundary files once a record has
+# latitude and longitude. Layers with overlapping polygons, such as
+# zoning_rco, are left out since AIS returns every polygon that matches.
+boundary_fields = [
+    "center_city_district",
+    "cua_zone",
+    "li_district",
+    "philly_rising_area",
+    "census_tract_2010",
+    "census_block_group_2010",
+    "census_block_2010",
+    "census_tract_2020",
+    "census_block_group_2020",
+    "census_block_2020",
+    "council_district_2016",
+    "council_district_2024",
+    "political_ward",
+    "political_division",
+    "state_house_rep_2012",
+    "state_house_rep_2022",
+    "state_senate_2012",
+    "state_senate_2022",
+    "us_congressional_2012",
+    "us_congressional_2018",
+    "us_congressional_2022",
+    "planning_district",
+    "elementary_school",
+    "middle_school",
+    "high_school",
+    "zoning",
+    "commercial_corridor",
+    "historic_district",
+    "police_division",
+    "police_district",
+    "police_service_area",
+    "rubbish_recycle_day",
+    "leaf_collection_area",
+    "sanitation_area",
+    "sanitation_district",
+    "highway_district",
+    "highway_section",
+    "highway_subsection",
+    "traffic_district",
+    "traffic_pm_district",
+    "pwd_maint_district",
+    "pwd_pressure_district",
+    "pwd_treatment_plant",
+    "pwd_water_plate",
+    "pwd_center_city_district",
+    "major_phila_watershed",
+    "neighborhood_advisory_committee",
+    "engine_local",
+    "ladder_local",
+]
@@ -1,3 +1,4 @@
+import pytest, time
 import utils.ais_lookup as ais_lookup
 
 
@@ -90,3 +91,230 @@ def test_false_address_returns_none_if_bad_address(monkeypatch):
         "is_philly_addr": False,
         "output_address": "",
     }
+
+
+def test_shared_rate_limiter_spaces_requests_across_limiters(tmp_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ais_lookup.time, "time", lambda: 1000.0)
+    monkeypatch.setattr(ais_lookup.time, "sleep", sleeps.append)
+
+    path = str(tmp_path / "rate_limit.sqlite")
+
+    # Two limiters on the same file stand in for two separate jobs
+    first = ais_lookup.SharedRateLimiter("key", 10, path)
+    second = ais_lookup.SharedRateLimiter("key", 10, path)
+    other_key = ais_lookup.SharedRateLimiter("other key", 10, path)
+
+    first.wait()
+    second.wait()
+    first.wait()
+    other_key.wait()
+
+    assert sleeps == pytest.approx([0.1, 0.2])
+
+
+def test_shared_rate_limiter_uses_stored_quota_for_key(tmp_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ais_lookup.time, "time", lambda: 1000.0)
+    monkeypatch.setattr(ais_lookup.time, "sleep", sleeps.append)
+
+    path = str(tmp_path / "rate_limit.sqlite")
+
+    # The quota set by the most recent job applies to every job on the key
+    first = ais_lookup.SharedRateLimiter("key", 10, path)
+    second = ais_lookup.SharedRateLimiter("key", 4, path)
+
+    first.wait()
+    first.wait()
+    second.wait()
+
+    assert sleeps == pytest.approx([0.25, 0.5])
+
+
+def test_shared_rate_limiter_upgrades_old_files(tmp_path):
+    path = str(tmp_path / "rate_limit.sqlite")
+
+    conn = ais_lookup.sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE rate_limits (api_key TEXT PRIMARY KEY, next_time REAL NOT NULL)"
+    )
+    conn.commit()
+    conn.close()
+
+    limiter = ais_lookup.SharedRateLimiter("key", 1000, path)
+    limiter.wait()
+
+    conn = ais_lookup.sqlite3.connect(path)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(rate_limits)")]
+    rps = conn.execute(
+        "SELECT rps FROM rate_limits WHERE api_key = ?", (limiter.key,)
+    ).fetchone()[0]
+    conn.close()
+
+    assert "rps" in columns
+    assert rps == 1000
+
+
+def test_throttle_ais_lookup_uses_given_rate_limiter(monkeypatch):
+    waits = []
+
+    class FakeLimiter:
+        def wait(self):
+            waits.append(True)
+
+    monkeypatch.setattr(ais_lookup, "ais_lookup", lambda *a: {"output_address": ""})
+
+    ais_lookup.throttle_ais_lookup(None, "1234", "1234 mkt st", [], FakeLimiter())
+
+    assert waits == [True]
+
+
+def test_server_error_raises_without_retrying(monkeypatch):
+    calls = []
+
+    class FakeResponse:
+        status_code = 503
+
+    class FakeSession:
+        def get(self, *a, **k):
+            calls.append(a)
+            return FakeResponse()
+
+    with pytest.raises(ais_lookup.AISUnavailableError):
+        ais_lookup.ais_lookup(FakeSession(), "1234", "1234 mkt st", [])
+
+    assert len(calls) == 1
+
+
+def test_circuit_breaker_opens_and_allows_one_trial(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(ais_lookup.time, "monotonic", lambda: clock[0])
+
+    breaker = ais_lookup.CircuitBreaker(threshold=0.5, window=4, cooldown=30)
+
+    for success in [True, False, True, False]:
+        breaker.wait()
+        breaker.record(success)
+
+    assert breaker.state == "open"
+
+    # After the cooldown, one trial request is let through
+    clock[0] = 31.0
+    breaker.wait()
+    assert breaker.state == "half_open"
+
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    clock[0] = 62.0
+    breaker.wait()
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+
+def test_throttle_ais_lookup_records_failures(monkeypatch):
+    def failing_lookup(*a):
+        raise ais_lookup.AISUnavailableError("5xx response")
+
+    monkeypatch.setattr(ais_lookup, "ais_lookup", failing_lookup)
+
+    class FakeLimiter:
+        def wait(self):
+            pass
+
+    breaker = ais_lookup.CircuitBreaker(window=1)
+
+    with pytest.raises(ais_lookup.AISUnavailableError):
+        ais_lookup.throttle_ais_lookup(
+            None, "1234", "1234 mkt st", [], FakeLimiter(), breaker
+        )
+
+    assert breaker.state == "open"
+
+
+def test_throttle_ais_lookup_releases_trial_when_limiter_fails(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(ais_lookup.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(ais_lookup, "ais_lookup", lambda *a: {"output_address": ""})
+
+    class FailingLimiter:
+        def wait(self):
+            raise OSError("rate limit file is locked")
+
+    breaker = ais_lookup.CircuitBreaker(window=1, cooldown=30)
+    breaker.record(False)
+    clock[0] = 31.0
+
+    with pytest.raises(OSError):
+        ais_lookup.throttle_ais_lookup(
+            None, "1234", "1234 mkt st", [], FailingLimiter(), breaker
+        )
+
+    # The failed trial reopens the breaker instead of holding the slot
+    assert breaker.state == "open"
+    clock[0] = 62.0
+    breaker.wait()
+    assert breaker.state == "half_open"
+
+
+def test_circuit_breaker_raises_while_open(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(ais_lookup.time, "monotonic", lambda: clock[0])
+
+    breaker = ais_lookup.CircuitBreaker(window=1, cooldown=30)
+    breaker.record(False)
+
+    with pytest.raises(ais_lookup.CircuitOpenError):
+        breaker.wait()
+
+    # While the trial request runs, other requests are also turned away
+    clock[0] = 31.0
+    breaker.wait()
+
+    with pytest.raises(ais_lookup.CircuitOpenError):
+        breaker.wait()
+
+
+def test_circuit_breaker_blocks_for_one_cooldown_only():
+    breaker = ais_lookup.CircuitBreaker(window=1, cooldown=0.05)
+    breaker.record(False)
+
+    # Waits out the cooldown, then takes the trial request
+    breaker.wait(block=True)
+    assert breaker.state == "half_open"
+
+    # Once the outage has lasted a cooldown, blocking callers fail fast
+    breaker.record(False)
+    with pytest.raises(ais_lookup.CircuitOpenError):
+        breaker.wait(block=True)
+
+
+def test_circuit_breaker_blocks_for_a_trial_after_a_long_outage():
+    breaker = ais_lookup.CircuitBreaker(window=1, cooldown=0.05)
+    breaker.record(False)
+
+    # The breaker has already failed a trial before anyone blocks on it
+    time.sleep(0.06)
+    breaker.wait()
+    breaker.record(False)
+
+    # The first blocking caller still gets to wait for the next trial
+    breaker.wait(block=True)
+    assert breaker.state == "half_open"
+
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+
+def test_retry_with_backoff_does_not_retry_open_circuit():
+    calls = []
+
+    @ais_lookup.retry_with_backoff
+    def lookup(address):
+        calls.append(address)
+        raise ais_lookup.CircuitOpenError("open")
+
+    with pytest.raises(ais_lookup.CircuitOpenError):
+        lookup("1234 mkt st")
+
+    assert calls == ["1234 mkt st"]
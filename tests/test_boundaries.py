@@ -0,0 +1,136 @@
+import json, polars as pl, pytest
+from utils.boundaries import (
+    assign_boundary_fields,
+    load_boundary_files,
+    read_boundary_file,
+)
+
+shapely = pytest.importorskip("shapely", minversion="2.0")
+
+
+def square(x, y):
+    return {
+        "type": "Polygon",
+        "coordinates": [[[x, y], [x + 1, y], [x + 1, y + 1], [x, y + 1], [x, y]]],
+    }
+
+
+def write_geojson(tmp_path):
+    path = tmp_path / "districts.geojson"
+    path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "geometry": square(0, 0),
+                        "properties": {"DIST": 1, "NAME": "West"},
+                    },
+                    {
+                        "type": "Feature",
+                        "geometry": square(1, 0),
+                        "properties": {"DIST": 2, "NAME": "East"},
+                    },
+                ],
+            }
+        )
+    )
+    return str(path)
+
+
+def test_lookup_finds_containing_polygon(tmp_path):
+    layer = read_boundary_file(write_geojson(tmp_path))
+
+    result = layer.lookup([0.5, 1.5, 5.0], [0.5, 0.5, 5.0], ["DIST", "NAME"])
+
+    assert result == {"DIST": ["1", "2", None], "NAME": ["West", "East", None]}
+
+
+def test_lookup_assigns_shared_edges_to_first_polygon(tmp_path):
+    layer = read_boundary_file(write_geojson(tmp_path))
+
+    result = layer.lookup([1.0, 0.0], [0.5, 0.0], ["DIST"])
+
+    assert result == {"DIST": ["1", "1"]}
+
+
+def test_read_geojson_with_null_properties(tmp_path):
+    path = tmp_path / "districts.geojson"
+    path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {"type": "Feature", "geometry": square(0, 0), "properties": None},
+                    {
+                        "type": "Feature",
+                        "geometry": square(1, 0),
+                        "properties": {"DIST": 2},
+                    },
+                ],
+            }
+        )
+    )
+
+    layer = read_boundary_file(str(path))
+
+    assert layer.lookup([0.5, 1.5], [0.5, 0.5], ["DIST"]) == {"DIST": [None, "2"]}
+
+
+def test_read_geoparquet(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    table = pa.table(
+        {
+            "DIST": [1, 2],
+            "geometry": [
+                shapely.to_wkb(shapely.geometry.shape(square(0, 0))),
+                shapely.to_wkb(shapely.geometry.shape(square(1, 0))),
+            ],
+        }
+    )
+    geo = {"version": "1.0.0", "primary_column": "geometry", "columns": {}}
+    table = table.replace_schema_metadata({"geo": json.dumps(geo)})
+    path = tmp_path / "districts.parquet"
+    pq.write_table(table, path)
+
+    layer = read_boundary_file(str(path))
+
+    assert layer.lookup([1.5], [0.5], ["DIST"]) == {"DIST": ["2"]}
+
+
+def test_load_boundary_files_rejects_non_polygon_fields(tmp_path):
+    config = {
+        "enrichment_fields": ["opa_owners"],
+        "boundary_files": [
+            {"path": write_geojson(tmp_path), "fields": {"opa_owners": "NAME"}}
+        ],
+    }
+
+    with pytest.raises(ValueError, match="opa_owners"):
+        load_boundary_files(config)
+
+
+def test_assign_boundary_fields_fills_missing_values(tmp_path):
+    config = {
+        "enrichment_fields": ["police_district"],
+        "boundary_files": [
+            {"path": write_geojson(tmp_path), "fields": {"police_district": "DIST"}}
+        ],
+    }
+    layers = load_boundary_files(config)
+
+    df = pl.DataFrame(
+        {
+            "geocode_lat": ["0.5", "0.5", None, "0.5"],
+            "geocode_lon": ["1.5", "0.5", "0.5", "0.5"],
+            "police_district": [None, None, None, "9"],
+        },
+        schema_overrides={"police_district": pl.String},
+    )
+
+    result = assign_boundary_fields(df, layers)
+
+    assert result["police_district"].to_list() == ["2", "1", None, "9"]
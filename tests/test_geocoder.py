@@ -1,5 +1,7 @@
-import pytest
-from geocoder import build_enrichment_fields
+import pytest, polars as pl, yaml
+from click.testing import CliRunner
+import geocoder
+from geocoder import build_ais_failure, build_enrichment_fields, enrich_with_ais
 
 
 def test_build_enrichment_fields_returns_fields():
@@ -35,3 +37,111 @@ def test_build_enrichment_fields_errors_if_invalid_field():
 
     with pytest.raises(ValueError):
         build_enrichment_fields(config)
+
+
+def test_enrich_with_ais_keeps_parsed_values_for_failed_lookups():
+    to_add = pl.DataFrame(
+        {
+            "output_address": ["1234 MARKET ST", "1 S BROAD ST"],
+            "is_addr": [True, True],
+            "is_philly_addr": [True, True],
+            "geocode_lat": [None, None],
+            "geocode_lon": [None, None],
+            "ais_status": [None, None],
+        },
+        schema_overrides={
+            "geocode_lat": pl.String,
+            "geocode_lon": pl.String,
+            "ais_status": pl.String,
+        },
+    )
+
+    results = {
+        "1234 MARKET ST": build_ais_failure(),
+        "1 S BROAD ST": {
+            "output_address": "1 S BROAD ST",
+            "is_addr": True,
+            "is_philly_addr": True,
+            "geocode_lat": "39.95",
+            "geocode_lon": "-75.16",
+            "ais_status": "found",
+        },
+    }
+
+    enriched = enrich_with_ais(to_add, results, [])
+
+    assert enriched.row(0, named=True) == {
+        "output_address": "1234 MARKET ST",
+        "is_addr": True,
+        "is_philly_addr": True,
+        "geocode_lat": None,
+        "geocode_lon": None,
+        "ais_status": "failed",
+    }
+    assert enriched["geocode_lat"][1] == "39.95"
+    assert enriched["ais_status"][1] == "found"
+
+
+def test_rows_with_coordinates_are_sent_to_ais_for_non_boundary_fields(
+    tmp_path, monkeypatch
+):
+    input_path = tmp_path / "input.csv"
+    pl.DataFrame(
+        {
+            "address": ["1234 market st", "1 s broad st"],
+            "lat": [39.95, None],
+            "lon": [-75.16, None],
+        }
+    ).write_csv(input_path)
+
+    geo_path = tmp_path / "addresses.parquet"
+    pl.DataFrame(
+        {
+            "street_address": ["100 FAKE ST"],
+            "opa_account_num": ["000000000"],
+            "geocode_lat": ["39.9"],
+            "geocode_lon": ["-75.1"],
+        }
+    ).write_parquet(geo_path)
+
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        yaml.safe_dump(
+            {
+                "input_file": str(input_path),
+                "geography_file": str(geo_path),
+                "full_address_field": "address",
+                "enrichment_fields": ["opa_account_num"],
+                "coordinate_fields": {"latitude": "lat", "longitude": "lon"},
+            }
+        )
+    )
+
+    looked_up = []
+
+    def lookup(address, block=False):
+        looked_up.append(address)
+        return {
+            "output_address": address,
+            "is_addr": True,
+            "is_philly_addr": True,
+            "geocode_lat": "39.95",
+            "geocode_lon": "-75.16",
+            "opa_account_num": "883309050",
+            "ais_status": "found",
+        }
+
+    monkeypatch.setattr(
+        geocoder, "make_ais_lookup", lambda config, fields: (lookup, lookup)
+    )
+
+    result = CliRunner().invoke(
+        geocoder.process_csv, ["--config_path", str(config_path)]
+    )
+    assert result.exit_code == 0, result.output
+
+    out = pl.read_csv(tmp_path / "input_enriched.csv")
+
+    assert sorted(looked_up) == ["1 S BROAD ST", "1234 MARKET ST"]
+    assert out["opa_account_num"].to_list() == [883309050, 883309050]
+    assert out["ais_status"].to_list() == ["found", "found"]
@@ -1,7 +1,13 @@
-import pytest, yaml
+import pytest, yaml, polars as pl
 from passyunk.parser import PassyunkParser
 from functools import partial
-from utils.parse_address import parse_address, combine_fields, find_address_fields
+from utils.parse_address import (
+    ParseCache,
+    parse_address,
+    combine_fields,
+    find_address_fields,
+    parse_distinct_addresses,
+)
 
 p = PassyunkParser()
 parse = partial(parse_address, p)
@@ -125,3 +131,51 @@ def test_combine_fields_handles_single_field():
     result = combine_fields(fields, record)
 
     assert result == "1234 market st"
+
+
+def test_parse_distinct_addresses_parses_each_address_once():
+    calls = []
+
+    class CountingParser:
+        def parse(self, address):
+            calls.append(address)
+            return p.parse(address)
+
+    cache = ParseCache()
+    first = parse_distinct_addresses(
+        CountingParser(),
+        pl.Series("joined_address", ["123 mkt", "123 mkt", "123 fake st"]),
+        cache,
+    )
+    second = parse_distinct_addresses(
+        CountingParser(),
+        pl.Series("joined_address", ["123 mkt", "not an address", "123 mkt"]),
+        cache,
+    )
+
+    assert sorted(calls) == ["123 fake st", "123 mkt", "not an address"]
+    assert first.height == 2
+    assert second.height == 2
+
+    parsed = second.filter(pl.col("joined_address") == "123 mkt").row(0, named=True)
+    assert parsed["output_address"] == "123 MARKET ST"
+    assert parsed["is_philly_addr"] == True
+
+
+def test_parse_cache_drops_oldest_addresses_when_full():
+    calls = []
+
+    class CountingParser:
+        def parse(self, address):
+            calls.append(address)
+            return p.parse(address)
+
+    cache = ParseCache(max_size=1)
+    for batch in [["123 mkt", "123 fake st"], ["1 s broad st"], ["123 mkt"]]:
+        parse_distinct_addresses(
+            CountingParser(), pl.Series("joined_address", batch), cache
+        )
+
+    # 123 mkt was dropped to make room for 1 s broad st, so it is parsed again
+    assert calls.count("123 mkt") == 2
+    assert cache.parsed.height == 1
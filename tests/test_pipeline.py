@@ -0,0 +1,209 @@
+import polars as pl, pytest, threading, time
+from utils.ais_lookup import CircuitBreaker
+from utils.pipeline import StagedPipeline
+
+
+def make_batches():
+    return [
+        pl.DataFrame({"__geocode_idx__": [0, 1, 2], "output_address": ["A", "B", "C"]}),
+        pl.DataFrame({"__geocode_idx__": [3, 4], "output_address": ["B", "D"]}),
+        pl.DataFrame(
+            {"__geocode_idx__": [5], "output_address": [None]},
+            schema={"__geocode_idx__": pl.Int64, "output_address": pl.String},
+        ),
+    ]
+
+
+def prepare(batch):
+    # Address A is matched locally
+    return (batch, batch.filter((pl.col("output_address") != "A").fill_null(True)))
+
+
+def finish(todo, results):
+    return todo.with_columns(
+        pl.col("output_address").replace_strict(
+            results, default=None, return_dtype=pl.String
+        )
+    )
+
+
+def test_pipeline_writes_batches_in_order():
+    written = []
+
+    def lookup(address):
+        # Slow down early addresses so later batches finish first
+        time.sleep(0.05 if address == "B" else 0)
+        return address.lower()
+
+    pipeline = StagedPipeline(prepare, lookup, finish, written.append, workers=3)
+    pipeline.run(make_batches())
+
+    assert [df["__geocode_idx__"].to_list() for df in written] == [
+        [0, 1, 2],
+        [3, 4],
+        [5],
+    ]
+    assert pl.concat(written)["output_address"].to_list() == [
+        "A",
+        "b",
+        "c",
+        "b",
+        "d",
+        None,
+    ]
+
+
+def test_pipeline_looks_up_each_address_once():
+    calls = []
+    lock = threading.Lock()
+
+    def lookup(address):
+        with lock:
+            calls.append(address)
+        return address.lower()
+
+    pipeline = StagedPipeline(prepare, lookup, finish, lambda df: None, workers=2)
+    pipeline.run(make_batches())
+
+    assert sorted(calls) == ["B", "C", "D"]
+
+
+def test_pipeline_raises_lookup_errors():
+    def lookup(address):
+        raise RuntimeError("AIS is down")
+
+    pipeline = StagedPipeline(
+        prepare, lookup, finish, lambda df: None, workers=2, queue_size=1
+    )
+
+    with pytest.raises(RuntimeError, match="AIS is down"):
+        pipeline.run(make_batches())
+
+
+def test_pipeline_defers_failed_lookups():
+    retries = []
+    lock = threading.Lock()
+
+    def lookup(address):
+        if address in ("B", "C"):
+            raise RuntimeError("AIS is down")
+        return address.lower()
+
+    def retry_lookup(address):
+        with lock:
+            retries.append(address)
+        if address == "B":
+            raise RuntimeError("AIS is still down")
+        return address.lower()
+
+    written = []
+    pipeline = StagedPipeline(
+        prepare,
+        lookup,
+        finish,
+        written.append,
+        workers=2,
+        retry_lookup=retry_lookup,
+        on_failure=lambda address, e: "failed",
+    )
+    pipeline.run(make_batches())
+
+    assert sorted(retries) == ["B", "C"]
+    assert pipeline.failed == ["B"]
+    assert pl.concat(written)["output_address"].to_list() == [
+        "A",
+        "failed",
+        "c",
+        "failed",
+        "d",
+        None,
+    ]
+
+
+def test_pipeline_spills_batches_waiting_behind_deferred_lookups(tmp_path):
+    failed = []
+    spilled = []
+
+    def lookup(address):
+        if address == "B" and "B" not in failed:
+            failed.append(address)
+            raise RuntimeError("AIS is down")
+        return address.lower()
+
+    written = []
+
+    def write(df):
+        spilled.append(len(list(tmp_path.rglob("*.arrow"))))
+        written.append(df)
+
+    pipeline = StagedPipeline(
+        prepare,
+        lookup,
+        finish,
+        write,
+        workers=2,
+        max_batches=1,
+        spill_dir=str(tmp_path),
+    )
+    pipeline.run(make_batches())
+
+    # The first batch waits on B until the retries at the end of the run,
+    # so the batches after it were spilled to disk
+    assert spilled[0] > 0
+    assert pl.concat(written)["output_address"].to_list() == [
+        "A",
+        "b",
+        "c",
+        "b",
+        "d",
+        None,
+    ]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pipeline_outage_that_ends_mid_run_fails_no_rows():
+    breaker = CircuitBreaker(window=2, cooldown=0.05)
+    start = time.monotonic()
+
+    def lookup(address, block=False):
+        breaker.wait(block)
+
+        # AIS is down from 0.1 to 0.4 seconds into the run
+        if 0.1 <= time.monotonic() - start < 0.4:
+            breaker.record(False)
+            raise RuntimeError("AIS is down")
+
+        breaker.record(True)
+        return address.lower()
+
+    def slow_prepare(batch):
+        time.sleep(0.02)
+        return (batch, batch)
+
+    batches = [
+        pl.DataFrame(
+            {
+                "__geocode_idx__": [i * 5 + j for j in range(5)],
+                "output_address": [f"{i * 5 + j} MARKET ST" for j in range(5)],
+            }
+        )
+        for i in range(40)
+    ]
+
+    written = []
+    pipeline = StagedPipeline(
+        slow_prepare,
+        lookup,
+        finish,
+        written.append,
+        workers=4,
+        max_batches=2,
+        retry_lookup=lambda address: lookup(address, block=True),
+        on_failure=lambda address, e: "failed",
+    )
+    pipeline.run(batches)
+
+    assert pipeline.failed == []
+    assert pl.concat(written)["output_address"].to_list() == [
+        f"{i} market st" for i in range(200)
+    ]
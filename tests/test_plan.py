@@ -0,0 +1,154 @@
+import polars as pl, time
+from utils.plan import build_plan, count_addresses, estimate_runtime, format_plan
+
+
+class FakeParser:
+    def parse(self, address):
+        return {
+            "components": {
+                "output_address": address.upper(),
+                "address": {"isaddr": True},
+                "street": {"street_code": 1},
+            }
+        }
+
+
+def write_files(tmp_path):
+    input_path = tmp_path / "input.csv"
+    pl.DataFrame(
+        {
+            "addr_st": ["123 market st", "123 market st", "1 fake st", None],
+            "addr_zip": ["19107", "19107", None, "19107"],
+        }
+    ).write_csv(input_path)
+
+    geo_path = tmp_path / "addresses.parquet"
+    pl.DataFrame(
+        {
+            "street_address": ["123 MARKET ST 19107"],
+            "geocode_lat": ["39.95"],
+            "geocode_lon": ["-75.16"],
+        }
+    ).write_parquet(geo_path)
+
+    return str(input_path), str(geo_path)
+
+
+def test_count_addresses_groups_joined_addresses(tmp_path):
+    input_path, _ = write_files(tmp_path)
+
+    counts = count_addresses(input_path, ["addr_st", "addr_zip"]).sort("joined_address")
+
+    assert counts.to_dicts() == [
+        {"joined_address": " 19107", "count": 1, "needs_ais": 1},
+        {"joined_address": "1 fake st ", "count": 1, "needs_ais": 1},
+        {"joined_address": "123 market st 19107", "count": 2, "needs_ais": 2},
+    ]
+
+
+def test_build_plan_estimates_ais_load(tmp_path):
+    input_path, geo_path = write_files(tmp_path)
+
+    plan = build_plan(FakeParser(), input_path, geo_path, ["addr_st", "addr_zip"])
+
+    assert plan["total_rows"] == 4
+    assert plan["distinct_addresses"] == 3
+    assert plan["sampled_addresses"] == 3
+    assert plan["local_match_rate"] == 0.5
+    assert plan["ais_rows"] == 2
+    assert plan["distinct_ais_lookups"] == 2
+    assert plan["projected_ais_seconds"] == estimate_runtime(2)
+    assert plan["projected_seconds"] == max(
+        plan["projected_parse_seconds"], plan["projected_ais_seconds"]
+    )
+
+
+def test_build_plan_projects_parse_time_for_every_distinct_address(tmp_path):
+    input_path, geo_path = write_files(tmp_path)
+
+    class SlowParser(FakeParser):
+        def parse(self, address):
+            time.sleep(0.05)
+            return super().parse(address)
+
+    plan = build_plan(
+        SlowParser(), input_path, geo_path, ["addr_st", "addr_zip"], sample_size=1
+    )
+
+    # One address was parsed, but all three will be in a full run
+    assert plan["sampled_addresses"] == 1
+    assert plan["projected_parse_seconds"] >= 3 * 0.05
+    assert plan["projected_seconds"] == max(
+        plan["projected_parse_seconds"], plan["projected_ais_seconds"]
+    )
+    assert "Projected wall time" in format_plan(plan)
+
+
+def test_estimate_runtime_is_capped_by_rate_limit():
+    assert estimate_runtime(100, rate=10, concurrency=1) == 100 * 0.2
+    assert estimate_runtime(100, rate=10, concurrency=8) == 100 * 0.1
+
+
+def test_build_plan_counts_lookups_by_parsed_address(tmp_path):
+    _, geo_path = write_files(tmp_path)
+
+    input_path = tmp_path / "spellings.csv"
+    pl.DataFrame(
+        {"addr_st": ["1 fake st", "1 FAKE ST", "1 Fake St", "2 fake st"]}
+    ).write_csv(input_path)
+
+    plan = build_plan(FakeParser(), str(input_path), geo_path, ["addr_st"])
+
+    assert plan["distinct_addresses"] == 4
+    assert plan["distinct_ais_lookups"] == 2
+
+
+def test_build_plan_skips_rows_with_input_coordinates(tmp_path):
+    _, geo_path = write_files(tmp_path)
+
+    input_path = tmp_path / "coordinates.csv"
+    pl.DataFrame(
+        {
+            "addr_st": ["1 fake st", "1 fake st", "2 fake st", "3 fake st"],
+            "lat": [39.9, None, 39.9, None],
+            "lon": [-75.1, None, -75.1, None],
+        }
+    ).write_csv(input_path)
+
+    plan = build_plan(
+        FakeParser(),
+        str(input_path),
+        geo_path,
+        ["addr_st"],
+        coordinate_fields={"latitude": "lat", "longitude": "lon"},
+    )
+
+    assert plan["ais_rows"] == 2
+    assert plan["distinct_ais_lookups"] == 2
+
+
+def test_build_plan_sends_rows_with_coordinates_when_fields_need_ais(tmp_path):
+    _, geo_path = write_files(tmp_path)
+
+    input_path = tmp_path / "coordinates.csv"
+    pl.DataFrame(
+        {
+            "addr_st": ["1 fake st", "1 fake st", "2 fake st", "3 fake st"],
+            "lat": [39.9, None, 39.9, None],
+            "lon": [-75.1, None, -75.1, None],
+        }
+    ).write_csv(input_path)
+
+    # opa_account_num cannot be filled from coordinates, so every row
+    # still needs AIS
+    plan = build_plan(
+        FakeParser(),
+        str(input_path),
+        geo_path,
+        ["addr_st"],
+        coordinate_fields={"latitude": "lat", "longitude": "lon"},
+        ais_lookup_fields=["opa_account_num"],
+    )
+
+    assert plan["ais_rows"] == 4
+    assert plan["distinct_ais_lookups"] == 3
@@ -1,12 +1,26 @@
-import requests, polars as pl, time
+import requests, polars as pl, time, threading, sqlite3, hashlib, tempfile, os
+from collections import deque
 from retrying import retry
 
 
+class AISUnavailableError(Exception):
+    """
+    Raised when AIS responds with a server error or asks the client to
+    slow down, so the lookup can be tried again later.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while a circuit breaker is open.
+    """
+
+
 class RateLimiter:
     """
     A class to handle rate limiting of an API. Faster than
     calling time.sleep() because it takes into account response
-    lag from the API.
+    lag from the API. Safe to share between threads.
 
     Example usage:
     limiter = RateLimiter(10)
@@ -18,28 +32,217 @@ class RateLimiter:
     def __init__(self, rps: int):
         self.rate = 1.0 / rps
         self._last_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        # Holding the lock while sleeping spaces out calls from
+        # every thread sharing this limiter
+        with self._lock:
+            now = time.perf_counter()
+            remaining = self.rate - (now - self._last_time)
+
+            if remaining > 0:
+                time.sleep(remaining)
+                now = time.perf_counter()
+
+            self._last_time = now
+
+
+class SharedRateLimiter:
+    """
+    A rate limiter shared by every process on this computer that uses the
+    same API key, so that several geocoder jobs running at once stay under
+    the key's quota together. Coordinates through a small SQLite file that
+    records each key's quota and its next free request slot.
+
+    Each call to wait() reserves the next free slot and sleeps until it,
+    so callers are spaced out evenly across threads and processes. The
+    quota stored for a key is set by the most recently started limiter,
+    and every limiter using the key spaces requests by that quota.
+
+    Example usage:
+    limiter = SharedRateLimiter(api_key, 10)
+
+    limiter.wait()
+    (api call)
+    """
+
+    def __init__(self, api_key: str, rps: float, path: str = None):
+        self.rps = rps
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), "address-geocoder-rate-limit.sqlite"
+        )
+        # Store a hash of the key rather than the key itself
+        self.key = hashlib.sha256((api_key or "").encode()).hexdigest()
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits "
+                "(api_key TEXT PRIMARY KEY, next_time REAL NOT NULL, rps REAL)"
+            )
+
+            # Files written before quotas were stored have no rps column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(rate_limits)")]
+            if "rps" not in columns:
+                conn.execute("ALTER TABLE rate_limits ADD COLUMN rps REAL")
+
+            conn.execute(
+                "INSERT INTO rate_limits (api_key, next_time, rps) VALUES (?, 0, ?) "
+                "ON CONFLICT (api_key) DO UPDATE SET rps = excluded.rps",
+                (self.key, rps),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _reserve(self) -> float:
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE locks the file against other writers until commit
+            conn.execute("BEGIN IMMEDIATE")
+            next_time, rps = conn.execute(
+                "SELECT next_time, rps FROM rate_limits WHERE api_key = ?",
+                (self.key,),
+            ).fetchone()
+
+            now = time.time()
+            slot = max(now, next_time)
+
+            conn.execute(
+                "UPDATE rate_limits SET next_time = ? WHERE api_key = ?",
+                (slot + 1.0 / (rps or self.rps), self.key),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return slot - now
 
     def wait(self):
-        now = time.perf_counter()
-        remaining = self.rate - (now - self._last_time)
+        remaining = self._reserve()
 
         if remaining > 0:
             time.sleep(remaining)
-            now = time.perf_counter()
 
-        self._last_time = now
 
+class CircuitBreaker:
+    """
+    Stops requests to an API while it is failing, instead of sending it
+    more traffic. Opens when at least `threshold` of the last `window`
+    requests failed. While open, wait() raises CircuitOpenError so callers
+    can set the request aside. After `cooldown` seconds a single trial
+    request is let through: if it succeeds the breaker closes, otherwise
+    it opens again. Safe to share between threads.
 
-limiter = RateLimiter(10)
+    Example usage:
+    breaker = CircuitBreaker()
 
+    breaker.wait()
+    (api call)
+    breaker.record(success)
+    """
 
-# Code adapted from Alex Waldman and Roland MacDavid
-# https://github.com/CityOfPhiladelphia/databridge-etl-tools/blob/master/databridge_etl_tools/ais_geocoder/ais_request.py
-@retry(
+    def __init__(self, threshold: float = 0.5, window: int = 20, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+
+        self._outcomes = deque(maxlen=window)
+        self._open_until = 0.0
+        # Set by the first blocking wait while the breaker is not closed
+        self._block_until = None
+        self._trial_running = False
+        self._cond = threading.Condition()
+
+    def wait(self, block: bool = False):
+        """
+        Returns if a request may be sent, otherwise raises CircuitOpenError.
+        With block set, waits for the next cooldown and trial request instead
+        of raising. Blocking callers share that one wait: if the trial fails,
+        they all raise, so an outage costs them one cooldown however many of
+        them there are.
+        """
+        with self._cond:
+            while True:
+                if self.state == "closed":
+                    return
+
+                now = time.monotonic()
+                if self.state == "open" and now >= self._open_until:
+                    self.state = "half_open"
+                    self._trial_running = False
+
+                if self.state == "half_open" and not self._trial_running:
+                    self._trial_running = True
+                    return
+
+                if block and self._block_until is None:
+                    self._block_until = (
+                        self._open_until if self.state == "open" else now
+                    )
+
+                if not block or (self.state == "open" and now >= self._block_until):
+                    raise CircuitOpenError("AIS is failing, circuit breaker is open")
+
+                if self.state == "open":
+                    self._cond.wait(self._open_until - now)
+                else:
+                    # Wait for the trial request to finish
+                    self._cond.wait()
+
+    def record(self, success: bool):
+        with self._cond:
+            if self.state == "half_open":
+                if success:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                    self._block_until = None
+                else:
+                    self._open()
+
+            elif self.state == "closed":
+                self._outcomes.append(success)
+                failures = self._outcomes.count(False)
+
+                if (
+                    len(self._outcomes) == self._outcomes.maxlen
+                    and failures / len(self._outcomes) >= self.threshold
+                ):
+                    self._open()
+
+            self._cond.notify_all()
+
+    def _open(self):
+        self.state = "open"
+        self._open_until = time.monotonic() + self.cooldown
+        self._outcomes.clear()
+
+
+# Maximum number of AIS requests per second
+AIS_RATE_LIMIT = 10
+
+limiter = RateLimiter(AIS_RATE_LIMIT)
+
+
+# Retries a lookup with exponential backoff, waiting up to 10 seconds
+# between attempts. This blocks the caller, so it is only used for
+# lookups that already failed once. Lookups stopped by an open circuit
+# breaker are not retried.
+retry_with_backoff = retry(
     wait_exponential_multiplier=1000,
     wait_exponential_max=10000,
     stop_max_attempt_number=5,
+    retry_on_exception=lambda e: not isinstance(e, CircuitOpenError),
 )
+
+
+# Code adapted from Alex Waldman and Roland MacDavid
+# https://github.com/CityOfPhiladelphia/databridge-etl-tools/blob/master/databridge_etl_tools/ais_geocoder/ais_request.py
 def ais_lookup(
     sess: requests.Session, api_key: str, address: str, enrichment_fields: list
 ) -> dict:
@@ -64,9 +267,9 @@ def ais_lookup(
     response = sess.get(ais_url, params=params, timeout=10, verify=False)
 
     if response.status_code >= 500:
-        raise Exception("5xx response")
+        raise AISUnavailableError("5xx response")
     elif response.status_code == 429:
-        raise Exception("429 response")
+        raise AISUnavailableError("429 response")
 
     out_data = {}
     if response.status_code == 200:
@@ -112,10 +315,35 @@ def ais_lookup(
 
 
 def throttle_ais_lookup(
-    sess: requests.Session, api_key: str, address: str, enrichment_fields: list
+    sess: requests.Session,
+    api_key: str,
+    address: str,
+    enrichment_fields: list,
+    rate_limiter=None,
+    circuit_breaker: CircuitBreaker = None,
+    block: bool = False,
 ) -> dict:
     """
-    Helper function to throttle the number of API requests to 10 per second.
+    Helper function to throttle the number of API requests. Uses the given
+    rate limiter, or 10 requests per second for this process if none is given.
+    If a circuit breaker is given, raises CircuitOpenError while it is open
+    (or first waits out its cooldown, if block is set) and records whether
+    the lookup succeeded.
     """
-    limiter.wait()
-    return ais_lookup(sess, api_key, address, enrichment_fields)
+    if circuit_breaker:
+        circuit_breaker.wait(block)
+
+    # The limiter wait is inside the try so that an error in it still
+    # records a result, which frees the breaker's trial slot
+    try:
+        (rate_limiter or limiter).wait()
+        result = ais_lookup(sess, api_key, address, enrichment_fields)
+    except Exception:
+        if circuit_breaker:
+            circuit_breaker.record(False)
+        raise
+
+    if circuit_breaker:
+        circuit_breaker.record(True)
+
+    return result
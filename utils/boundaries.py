@@ -0,0 +1,209 @@
+import json, polars as pl
+from pathlib import PurePath
+from mapping.ais_properties_fields import boundary_fields
+
+try:
+    import numpy as np, shapely
+except ImportError:
+    shapely = None
+
+# The vectorized STRtree queries below need shapely 2
+if shapely is not None and int(shapely.__version__.split(".")[0]) < 2:
+    shapely = None
+
+
+class BoundaryLayer:
+    """
+    Polygons from one boundary file, indexed with an STR-tree so that
+    many points can be matched to polygons in one vectorized query.
+
+    Example usage:
+    layer = read_boundary_file("./data/census_blocks_2020.geojson")
+
+    layer.lookup(lons, lats, ["TRACTCE20", "BLOCKCE20"])
+    """
+
+    def __init__(self, geometries: list, properties: dict):
+        self.tree = shapely.STRtree(geometries)
+
+        # Values are returned as strings, to match fields returned by AIS
+        self.properties = {
+            name: np.array(
+                [None if v is None else str(v) for v in values], dtype=object
+            )
+            for name, values in properties.items()
+        }
+
+    def lookup(self, lons: list, lats: list, property_names: list) -> dict:
+        """
+        Finds the polygon each point falls in, and returns the requested
+        properties of that polygon for each point. Points outside of every
+        polygon get None. A point on the edge between polygons gets the
+        polygon that comes first in the file.
+
+        Args:
+            lons (list): Point longitudes
+            lats (list): Point latitudes
+            property_names (list): The polygon properties to return
+
+        Returns: A dict of lists, keyed by property name.
+        """
+        points = shapely.points(lons, lats)
+        point_idx, polygon_idx = self.tree.query(points, predicate="intersects")
+
+        # Keep the first polygon in the file for each point
+        order = np.lexsort((polygon_idx, point_idx))
+        point_idx, polygon_idx = point_idx[order], polygon_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+        point_idx, polygon_idx = point_idx[first], polygon_idx[first]
+
+        out = {}
+        for name in property_names:
+            values = np.full(len(points), None, dtype=object)
+            values[point_idx] = self.properties[name][polygon_idx]
+            out[name] = values.tolist()
+
+        return out
+
+
+def read_boundary_file(path: str) -> BoundaryLayer:
+    """
+    Reads a GeoJSON or GeoParquet file of polygons into a BoundaryLayer.
+    Coordinates must be longitude and latitude (EPSG:4326), as returned by AIS.
+    """
+    if shapely is None:
+        raise ImportError(
+            "shapely 2.0 or later is required to use boundary files. "
+            'Install it with: pip install ".[boundaries]"'
+        )
+
+    if PurePath(path).suffix.lower() in (".parquet", ".geoparquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        geo_metadata = json.loads(table.schema.metadata[b"geo"])
+        geometry_col = geo_metadata["primary_column"]
+
+        geometries = shapely.from_wkb(table[geometry_col].to_pylist())
+        properties = table.drop([geometry_col]).to_pydict()
+
+        return BoundaryLayer(geometries, properties)
+
+    with open(path, "r") as f:
+        features = json.load(f)["features"]
+
+    geometries = [shapely.geometry.shape(feature["geometry"]) for feature in features]
+
+    # GeoJSON allows features with null properties
+    feature_properties = [feature.get("properties") or {} for feature in features]
+
+    names = {name for props in feature_properties for name in props}
+    properties = {
+        name: [props.get(name) for props in feature_properties]
+        for name in names
+    }
+
+    return BoundaryLayer(geometries, properties)
+
+
+def load_boundary_files(config: dict) -> list:
+    """
+    Reads the boundary files listed in the config. Raises an error if a
+    listed field cannot be filled from a boundary file, or if it is not
+    one of the user's enrichment fields.
+
+    Args:
+        config (dict): A dictionary read from the config yaml file
+
+    Returns: A list of tuples of a BoundaryLayer and a dict mapping each
+    enrichment field to the layer property that holds it.
+    """
+    enrichment_fields = config.get("enrichment_fields") or []
+    layers = []
+
+    for boundary_file in config.get("boundary_files") or []:
+        field_map = boundary_file.get("fields") or {}
+
+        invalid_fields = [
+            field
+            for field in field_map
+            if field not in boundary_fields or field not in enrichment_fields
+        ]
+
+        if invalid_fields:
+            to_print = ", ".join(invalid_fields)
+            raise ValueError(
+                "The following fields cannot be added from boundary files: "
+                f"{to_print}. Boundary fields must be polygon-based "
+                "enrichment fields."
+            )
+
+        layer = read_boundary_file(boundary_file["path"])
+        missing = [prop for prop in field_map.values() if prop not in layer.properties]
+
+        if missing:
+            raise ValueError(
+                f"{boundary_file['path']} does not have the properties: "
+                f"{', '.join(missing)}."
+            )
+
+        layers.append((layer, field_map))
+
+    return layers
+
+
+def assign_boundary_fields(df: pl.DataFrame, layers: list) -> pl.DataFrame:
+    """
+    Fills boundary fields from the polygons each record's latitude and
+    longitude fall in. Only records with coordinates and at least one
+    missing boundary field are looked up, and existing values are kept.
+
+    Args:
+        df: A polars dataframe with geocode_lat and geocode_lon columns
+        layers: Boundary layers, as returned by load_boundary_files
+
+    Returns:
+        The dataframe with boundary fields filled in.
+    """
+    fields = [field for _, field_map in layers for field in field_map]
+    if not fields or df.is_empty():
+        return df
+
+    lat = pl.col("geocode_lat").cast(pl.Float64, strict=False)
+    lon = pl.col("geocode_lon").cast(pl.Float64, strict=False)
+
+    to_fill = df.with_row_index("__boundary_idx__").filter(
+        lat.is_not_null()
+        & lon.is_not_null()
+        & pl.any_horizontal([pl.col(field).is_null() for field in fields])
+    )
+
+    if to_fill.is_empty():
+        return df
+
+    lons = to_fill.select(lon)["geocode_lon"].to_list()
+    lats = to_fill.select(lat)["geocode_lat"].to_list()
+
+    filled = to_fill.select("__boundary_idx__")
+    for layer, field_map in layers:
+        values = layer.lookup(lons, lats, list(field_map.values()))
+
+        filled = filled.with_columns(
+            [
+                pl.Series(field, values[prop], dtype=pl.String).cast(
+                    df.schema[field], strict=False
+                )
+                for field, prop in field_map.items()
+            ]
+        )
+
+    # Keep values already on the record, e.g. from the address file
+    filled = filled.with_columns(
+        [pl.coalesce(to_fill[field], pl.col(field)).alias(field) for field in fields]
+    )
+
+    return (
+        df.with_row_index("__boundary_idx__")
+        .update(filled, on="__boundary_idx__", include_nulls=True)
+        .drop("__boundary_idx__")
+    )
@@ -1,6 +1,14 @@
-import yaml, re
+import yaml, re, polars as pl
 from typing import List
 
+# Columns of a parsed address, keyed by the address string
+PARSED_SCHEMA = {
+    "address": pl.String,
+    "output_address": pl.String,
+    "is_addr": pl.Boolean,
+    "is_philly_addr": pl.Boolean,
+}
+
 
 def find_address_fields(config_path) -> List[str]:
     """
@@ -34,6 +42,24 @@ def find_address_fields(config_path) -> List[str]:
     return fields
 
 
+def join_address_fields(fields: list) -> pl.Expr:
+    """
+    Builds a polars expression that concatenates the given address
+    fields into a single address string, stripping extra spaces left
+    from blank fields.
+
+    Args:
+        fields (list): The address field names in the input file.
+
+    Returns pl.Expr: An expression aliased to joined_address.
+    """
+    return (
+        pl.concat_str([pl.col(field).fill_null("") for field in fields], separator=" ")
+        .str.replace_all(r"\s+", " ")
+        .alias("joined_address")
+    )
+
+
 def combine_fields(fields: list, record: dict):
     joined = " ".join(record[field] for field in fields)
 
@@ -70,3 +96,67 @@ def parse_address(parser, address: str) -> tuple[str, bool, bool]:
         "is_addr": is_addr,
         "is_philly_addr": is_philly_addr,
     }
+
+
+class ParseCache:
+    """
+    Parsed addresses kept between batches, so that an address repeated
+    in later batches is not parsed again. Stored as a polars dataframe,
+    which is far smaller than a dict per address, and limited to max_size
+    addresses. Once full, the addresses parsed longest ago are dropped and
+    will be parsed again if they come up.
+
+    Example usage:
+    cache = ParseCache()
+
+    parse_distinct_addresses(parser, batch["joined_address"], cache)
+    """
+
+    def __init__(self, max_size: int = 1000000):
+        self.max_size = max_size
+        self.parsed = pl.DataFrame(schema=PARSED_SCHEMA)
+
+    def get(self, addresses: pl.Series) -> pl.DataFrame:
+        """
+        Returns the cached rows for the given distinct addresses.
+        """
+        return self.parsed.join(addresses.to_frame("address"), on="address", how="semi")
+
+    def add(self, parsed: pl.DataFrame):
+        # Appending without rechunking avoids copying the whole cache
+        self.parsed = pl.concat([self.parsed, parsed], rechunk=False)
+
+        if self.parsed.height > self.max_size:
+            self.parsed = self.parsed.tail(self.max_size)
+
+
+def parse_distinct_addresses(
+    parser, addresses: pl.Series, cache: ParseCache
+) -> pl.DataFrame:
+    """
+    Parses each distinct address in a series once. Results are stored in
+    cache, so an address seen in an earlier call is not parsed again.
+
+    Args:
+        parser: A PassyunkParser object
+        addresses: A series of address strings
+        cache (ParseCache): Parsed addresses shared between calls
+
+    Returns pl.DataFrame: One row per distinct address, with the address and
+    the output of parse_address.
+    """
+    distinct = addresses.drop_nulls().unique()
+
+    cached = cache.get(distinct)
+    to_parse = distinct.filter(~distinct.is_in(cached["address"].implode()))
+
+    parsed = pl.DataFrame(
+        [
+            {"address": address, **parse_address(parser, address)}
+            for address in to_parse
+        ],
+        schema=PARSED_SCHEMA,
+    )
+    cache.add(parsed)
+
+    return pl.concat([cached, parsed]).rename({"address": addresses.name})
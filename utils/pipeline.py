@@ -0,0 +1,300 @@
+import polars as pl, queue, threading, tempfile, os
+from typing import Callable, Iterable
+
+
+class StagedPipeline:
+    """
+    Runs the CPU stages (parsing, address file join) and the AIS stage of
+    the geocoder at the same time, so that AIS network waits overlap with
+    parsing instead of following it.
+
+    Each input batch is prepared once on the calling thread, which returns
+    the prepared batch and the subset of its rows that need AIS. Addresses
+    that need AIS are put on a bounded queue as soon as their batch is
+    prepared, and are drained by a pool of AIS worker threads. A writer
+    thread patches AIS results into each batch by __geocode_idx__ and emits
+    batches in input order once all of their addresses have been looked up.
+
+    Each distinct address is only sent to AIS once per run. Lookups that
+    fail are put on a deferred list instead of blocking a worker, and are
+    retried with retry_lookup once every other address has been looked up.
+
+    At most max_batches prepared batches are held in memory. Once the limit
+    is reached the producer waits for the writer, unless some addresses are
+    deferred: the batches waiting on those cannot be written until the
+    retries, so later batches are spilled to a temporary directory instead
+    and read back when their turn comes.
+
+    Example usage:
+    pipeline = StagedPipeline(prepare, lookup, finish, write, workers=4)
+    pipeline.run(batches)
+    """
+
+    def __init__(
+        self,
+        prepare: Callable[[pl.DataFrame], tuple],
+        lookup: Callable[[str], dict],
+        finish: Callable[[pl.DataFrame, dict], pl.DataFrame],
+        write: Callable[[pl.DataFrame], None],
+        workers: int = 4,
+        queue_size: int = 1000,
+        max_batches: int = 10,
+        address_col: str = "output_address",
+        retry_lookup: Callable[[str], dict] = None,
+        on_failure: Callable[[str, Exception], dict] = None,
+        spill_dir: str = None,
+    ):
+        """
+        Args:
+            prepare: Given an input batch, returns a tuple of the prepared
+                batch and the rows of it that need AIS
+            lookup: Given an address, returns the AIS result for it
+            finish: Given the rows that needed AIS and a dict of AIS results
+                keyed by address, returns the enriched rows
+            write: Writes a finished batch
+            workers (int): The number of AIS worker threads
+            queue_size (int): The maximum number of addresses waiting for AIS
+            max_batches (int): The maximum number of prepared batches held
+                in memory before they are written
+            address_col (str): The column holding the address to look up
+            retry_lookup: Used instead of lookup for deferred addresses.
+                Defaults to lookup
+            on_failure: Given an address and the error from its last retry,
+                returns the result to use for it. If not given, the error
+                is raised
+            spill_dir (str): Where to create the temporary directory for
+                spilled batches. Defaults to the system temp directory
+        """
+        self.prepare = prepare
+        self.lookup = lookup
+        self.finish = finish
+        self.write = write
+        self.workers = workers
+        self.max_batches = max_batches
+        self.address_col = address_col
+        self.retry_lookup = retry_lookup or lookup
+        self.on_failure = on_failure
+        self.spill_dir = spill_dir
+
+        # Addresses whose retries also failed
+        self.failed = []
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._cond = threading.Condition()
+
+        self._results = {}
+        # Address -> ids of the batches waiting for its AIS result
+        self._waiting = {}
+        # Addresses whose first lookup failed, to be retried at the end
+        self._deferred = []
+        # Batch id -> [prepared batch, rows needing AIS, pending lookups].
+        # The frames are None for batches spilled to disk
+        self._batches = {}
+        self._in_memory = 0
+        self._spill_path = None
+        self._total_batches = None
+        self._error = None
+
+    def run(self, batches: Iterable[pl.DataFrame]):
+        """
+        Processes every batch and returns once all batches are written.
+        Re-raises the first exception raised by any stage.
+        """
+        workers = [
+            threading.Thread(target=self._ais_worker, daemon=True)
+            for _ in range(self.workers)
+        ]
+        writer = threading.Thread(target=self._writer, daemon=True)
+
+        spill = tempfile.TemporaryDirectory(dir=self.spill_dir)
+        self._spill_path = spill.name
+
+        for thread in [*workers, writer]:
+            thread.start()
+
+        batch_id = 0
+        try:
+            for batch in batches:
+                self._wait_for_room()
+                if self._error:
+                    break
+                self._add_batch(batch_id, batch)
+                batch_id += 1
+
+            # Wait for the first lookup of every address, then retry
+            # the ones that failed
+            self._queue.join()
+            self._retry_deferred()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            with self._cond:
+                self._total_batches = batch_id
+                self._cond.notify_all()
+
+            for _ in workers:
+                self._queue.put(None)
+
+            for thread in [*workers, writer]:
+                thread.join()
+
+            spill.cleanup()
+
+        if self._error:
+            raise self._error
+
+    def _fail(self, error: BaseException):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def _retry_deferred(self):
+        with self._cond:
+            deferred, self._deferred = self._deferred, []
+
+        for address in deferred:
+            self._queue.put((address, True))
+
+        self._queue.join()
+
+    def _wait_for_room(self):
+        # Deferred addresses are only retried at the end of the run, so
+        # while there are any the writer may be stuck behind them, and the
+        # next batch is spilled to disk rather than waited for
+        with self._cond:
+            while (
+                self._in_memory >= self.max_batches
+                and not self._deferred
+                and not self._error
+            ):
+                self._cond.wait()
+
+    def _batch_files(self, batch_id: int) -> tuple:
+        return tuple(
+            os.path.join(self._spill_path, f"{batch_id}_{name}.arrow")
+            for name in ("frame", "todo")
+        )
+
+    def _add_batch(self, batch_id: int, batch: pl.DataFrame):
+        frame, todo = self.prepare(batch)
+        addresses = todo[self.address_col].drop_nulls().unique()
+
+        with self._cond:
+            spill = self._in_memory >= self.max_batches
+
+        if spill:
+            for df, path in zip((frame, todo), self._batch_files(batch_id)):
+                df.write_ipc(path)
+            frame = todo = None
+
+        to_queue = []
+        with self._cond:
+            pending = 0
+            for address in addresses:
+                if address in self._results:
+                    continue
+
+                if address not in self._waiting:
+                    self._waiting[address] = []
+                    to_queue.append(address)
+
+                self._waiting[address].append(batch_id)
+                pending += 1
+
+            self._batches[batch_id] = [frame, todo, pending]
+            if not spill:
+                self._in_memory += 1
+            self._cond.notify_all()
+
+        # Queue outside the lock, since put blocks while the queue is full
+        for address in to_queue:
+            self._queue.put((address, False))
+
+    def _ais_worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                # Keep draining the queue after a failure so that the
+                # producer is never left blocked on a full queue
+                if self._error:
+                    continue
+
+                address, is_retry = item
+                lookup = self.retry_lookup if is_retry else self.lookup
+
+                try:
+                    result = lookup(address)
+                except Exception as e:
+                    if not is_retry:
+                        with self._cond:
+                            self._deferred.append(address)
+                            self._cond.notify_all()
+                        continue
+
+                    if self.on_failure is None:
+                        self._fail(e)
+                        continue
+
+                    result = self.on_failure(address, e)
+                    with self._cond:
+                        self.failed.append(address)
+
+                with self._cond:
+                    self._results[address] = result
+                    for batch_id in self._waiting.pop(address):
+                        self._batches[batch_id][2] -= 1
+                    self._cond.notify_all()
+            except BaseException as e:
+                self._fail(e)
+            finally:
+                self._queue.task_done()
+
+    def _writer(self):
+        batch_id = 0
+        while True:
+            with self._cond:
+                while not self._error and not self._batch_ready(batch_id):
+                    if self._total_batches == batch_id:
+                        return
+                    self._cond.wait()
+
+                if self._error:
+                    return
+
+                frame, todo, _ = self._batches.pop(batch_id)
+                if frame is not None:
+                    self._in_memory -= 1
+                self._cond.notify_all()
+
+            try:
+                if frame is None:
+                    paths = self._batch_files(batch_id)
+                    frame, todo = [
+                        pl.read_ipc(path, memory_map=False) for path in paths
+                    ]
+                    for path in paths:
+                        os.remove(path)
+
+                with self._cond:
+                    results = {
+                        address: self._results[address]
+                        for address in todo[self.address_col].drop_nulls().unique()
+                    }
+
+                enriched = self.finish(todo, results)
+                self.write(
+                    frame.update(enriched, on="__geocode_idx__", include_nulls=True)
+                )
+            except BaseException as e:
+                self._fail(e)
+                return
+
+            batch_id += 1
+
+    def _batch_ready(self, batch_id: int) -> bool:
+        batch = self._batches.get(batch_id)
+        return batch is not None and batch[2] == 0
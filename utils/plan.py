@@ -0,0 +1,234 @@
+import polars as pl, time
+from utils.parse_address import join_address_fields, parse_address
+from utils.ais_lookup import AIS_RATE_LIMIT
+
+# Average time for one AIS response, in seconds. Based on the observed
+# 3-4 minutes per 1,000 rows sent to AIS.
+AIS_SECONDS_PER_LOOKUP = 0.2
+
+
+def count_addresses(
+    filepath: str, address_fields: list, coordinate_fields: dict = None
+) -> pl.DataFrame:
+    """
+    Scans only the address (and input coordinate) columns of the input file
+    and counts how many rows share each joined address.
+
+    Args:
+        filepath (str): The path to the input csv
+        address_fields (list): The address field names in the input file
+        coordinate_fields (dict): Optional names of the input latitude and
+            longitude columns. Rows with both are not sent to AIS
+
+    Returns: A polars dataframe with one row per distinct joined_address,
+    a count column, and a needs_ais column counting rows without input
+    coordinates.
+    """
+    coordinate_fields = coordinate_fields or {}
+    lat_field = coordinate_fields.get("latitude")
+    lon_field = coordinate_fields.get("longitude")
+
+    if lat_field and lon_field:
+        has_coords = pl.col(lat_field).is_not_null() & pl.col(lon_field).is_not_null()
+        columns = [*address_fields, lat_field, lon_field]
+    else:
+        has_coords = pl.lit(False)
+        columns = address_fields
+
+    lf = (
+        pl.scan_csv(filepath)
+        .select(list(dict.fromkeys(columns)))
+        .select(join_address_fields(address_fields), has_coords.alias("has_coords"))
+    )
+
+    return (
+        lf.group_by("joined_address")
+        .agg(
+            pl.len().alias("count"),
+            (~pl.col("has_coords")).sum().cast(pl.UInt32).alias("needs_ais"),
+        )
+        .collect()
+    )
+
+
+def match_sample(
+    parser, geo_filepath: str, addresses: pl.DataFrame, sample_size: int, seed=None
+) -> pl.DataFrame:
+    """
+    Parses a random sample of distinct addresses and flags which of them
+    match a geocoded record in the address file.
+
+    Args:
+        parser: A PassyunkParser object
+        geo_filepath (str): The path to the address file
+        addresses (pl.DataFrame): Distinct addresses, as returned by
+            count_addresses
+        sample_size (int): The maximum number of distinct addresses to parse
+        seed: Optional random seed for the sample
+
+    Returns: A tuple of the sampled addresses, with output_address and a
+    boolean matched column added, and the seconds spent parsing them.
+    """
+    sample = addresses.sample(n=min(sample_size, addresses.height), seed=seed)
+
+    start = time.perf_counter()
+    sample = sample.with_columns(
+        pl.col("joined_address")
+        .map_elements(
+            lambda s: parse_address(parser, s)["output_address"],
+            return_dtype=pl.String,
+        )
+        .alias("output_address")
+    )
+    parse_seconds = time.perf_counter() - start
+
+    geocoded = (
+        pl.scan_parquet(geo_filepath)
+        .filter(
+            pl.col("geocode_lat").is_not_null() & pl.col("geocode_lon").is_not_null()
+        )
+        .select("street_address")
+        .unique()
+    )
+
+    matched = (
+        sample.lazy()
+        .join(geocoded, how="semi", left_on="output_address", right_on="street_address")
+        .select("joined_address")
+        .collect()
+    )
+
+    sample = sample.with_columns(
+        pl.col("joined_address")
+        .is_in(matched["joined_address"].implode())
+        .alias("matched")
+    )
+
+    return (sample, parse_seconds)
+
+
+def estimate_runtime(
+    lookups: int, rate: float = AIS_RATE_LIMIT, concurrency: int = 1
+) -> float:
+    """
+    Projects the wall time in seconds needed to send a number of lookups
+    to AIS. Each worker is limited by AIS response time, and all workers
+    together are limited by the rate limit.
+    """
+    seconds_per_lookup = max(1.0 / rate, AIS_SECONDS_PER_LOOKUP / concurrency)
+    return lookups * seconds_per_lookup
+
+
+def build_plan(
+    parser,
+    filepath: str,
+    geo_filepath: str,
+    address_fields: list,
+    sample_size: int = 5000,
+    seed=None,
+    rate: float = AIS_RATE_LIMIT,
+    concurrency: int = 1,
+    coordinate_fields: dict = None,
+    ais_lookup_fields: list = None,
+) -> dict:
+    """
+    Estimates the work a full geocoding run would do without calling AIS.
+    Counts every row, but only parses a sample of distinct addresses.
+
+    Args:
+        parser: A PassyunkParser object
+        filepath (str): The path to the input csv
+        geo_filepath (str): The path to the address file
+        address_fields (list): The address field names in the input file
+        sample_size (int): The maximum number of distinct addresses to parse
+        seed: Optional random seed for the sample
+        rate (float): The AIS rate limit in requests per second
+        concurrency (int): The number of AIS worker threads
+        coordinate_fields (dict): Optional names of the input latitude and
+            longitude columns
+        ais_lookup_fields (list): The enrichment fields that must come from
+            AIS. Rows with input coordinates only skip AIS if there are none
+
+    Returns: A dict of plan statistics.
+    """
+    # Input coordinates only stand in for AIS when boundary files cover
+    # every AIS field, as in a full run
+    if ais_lookup_fields:
+        coordinate_fields = None
+
+    addresses = count_addresses(filepath, address_fields, coordinate_fields)
+
+    total_rows = int(addresses["count"].sum() or 0)
+    distinct_addresses = addresses.height
+
+    if distinct_addresses:
+        sample, parse_seconds = match_sample(
+            parser, geo_filepath, addresses, sample_size, seed
+        )
+        sample_rows = sample["count"].sum()
+        row_match_rate = sample.filter(pl.col("matched"))["count"].sum() / sample_rows
+
+        # Rows that already have input coordinates skip AIS
+        to_ais = sample.filter(~pl.col("matched") & (pl.col("needs_ais") > 0))
+        ais_row_rate = to_ais["needs_ais"].sum() / sample_rows
+
+        # AIS lookups are deduplicated on the parsed address, so inputs
+        # that normalize to the same address only count once
+        lookup_rate = to_ais["output_address"].n_unique() / sample.height
+        seconds_per_parse = parse_seconds / sample.height
+        sampled = sample.height
+    else:
+        row_match_rate = 1.0
+        ais_row_rate = lookup_rate = seconds_per_parse = 0.0
+        sampled = 0
+
+    ais_rows = round(total_rows * ais_row_rate)
+    distinct_lookups = round(distinct_addresses * lookup_rate)
+
+    # Each distinct address is parsed once, on a single thread
+    parse_seconds = distinct_addresses * seconds_per_parse
+    # Each distinct address is only sent to AIS once
+    ais_seconds = estimate_runtime(distinct_lookups, rate=rate, concurrency=concurrency)
+
+    return {
+        "total_rows": total_rows,
+        "distinct_addresses": distinct_addresses,
+        "sampled_addresses": sampled,
+        "local_match_rate": row_match_rate,
+        "ais_rows": ais_rows,
+        "distinct_ais_lookups": distinct_lookups,
+        "projected_parse_seconds": parse_seconds,
+        "projected_ais_seconds": ais_seconds,
+        # Parsing and AIS lookups run at the same time, so the slower of
+        # the two sets the wall time
+        "projected_seconds": max(parse_seconds, ais_seconds),
+    }
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Formats a number of seconds as hours, minutes and seconds.
+    """
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
+
+
+def format_plan(plan: dict) -> str:
+    """
+    Formats the output of build_plan as a human-readable report.
+    """
+    lines = [
+        f"Total rows: {plan['total_rows']:,}",
+        f"Distinct addresses: {plan['distinct_addresses']:,}",
+        f"Addresses parsed for estimate: {plan['sampled_addresses']:,}",
+        f"Predicted address file match rate: {plan['local_match_rate']:.1%}",
+        f"Rows needing AIS: {plan['ais_rows']:,}",
+        f"Distinct AIS lookups needed: {plan['distinct_ais_lookups']:,}",
+        f"Projected parse time: {format_duration(plan['projected_parse_seconds'])}",
+        f"Projected AIS time: {format_duration(plan['projected_ais_seconds'])}",
+        f"Projected wall time: {format_duration(plan['projected_seconds'])}",
+    ]
+
+    return "\n".join(lines)